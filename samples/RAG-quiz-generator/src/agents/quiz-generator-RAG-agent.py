@@ -1,18 +1,28 @@
-from typing import Optional, List, Literal
+from collections import OrderedDict
+from typing import Iterator, Optional, List, Literal
 
 import httpx
+from langgraph.checkpoint.base import BaseCheckpointSaver
 from langgraph.graph import END, START, MessagesState, StateGraph
 from langgraph.types import Command, interrupt
-from pydantic import BaseModel, Field, field_validator, ValidationInfo
+from pydantic import BaseModel, Field, ValidationError, model_validator
 from uipath.platform import UiPath
-from langchain_core.output_parsers import PydanticOutputParser
+from langchain_core.exceptions import OutputParserException
+from langchain_core.outputs import Generation
+from langchain_community.cache import SQLiteCache
+import asyncio
 import logging
+import math
+import random
 import time
+import uuid
 from uipath.platform.common import InvokeProcess
 from uipath.platform.errors import IngestionInProgressException
 from uipath_langchain.retrievers import ContextGroundingRetriever
+from uipath_langchain.embeddings import UiPathAzureOpenAIEmbeddings
 from langchain_anthropic import ChatAnthropic
 from langchain_core.documents import Document
+from langchain_core.vectorstores import InMemoryVectorStore
 
 class IndexNotFound(Exception):
     pass
@@ -20,7 +30,31 @@ class IndexNotFound(Exception):
 
 logger = logging.getLogger(__name__)
 
-llm = ChatAnthropic(model="claude-3-7-sonnet-latest")
+class CompleteQuizCache(SQLiteCache):
+    """SQLite LLM cache that only admits responses containing a complete quiz.
+
+    Sampling is not deterministic (Anthropic defaults to temperature 1.0), so "insufficient info"
+    answers are never stored: a retry after the researcher run must reach the model again.
+    """
+
+    def update(self, prompt: str, llm_string: str, return_val: list[Generation]) -> None:
+        if all(is_complete_quiz(generation) for generation in return_val):
+            super().update(prompt, llm_string, return_val)
+
+def is_complete_quiz(generation: Generation) -> bool:
+    message = getattr(generation, "message", None)
+    tool_calls = getattr(message, "tool_calls", None)
+    if not tool_calls:
+        return False
+    # responses that fail schema validation would be replayed and fail on every identical prompt
+    try:
+        response = QuizOrInsufficientInfo.model_validate(tool_calls[0]["args"])
+    except ValidationError:
+        return False
+    return response.additional_info == "false"
+
+# only the quiz LLM is cached, identical prompts that produced a complete quiz are served from disk
+llm = ChatAnthropic(model="claude-3-7-sonnet-latest", cache=CompleteQuizCache(database_path=".llm_cache.db"))
 
 class QuizItem(BaseModel):
     question: str = Field(
@@ -44,26 +78,47 @@ class QuizOrInsufficientInfo(BaseModel):
         description="String that controls whether additional information is required",
     )
 
-    @field_validator("quiz")
-    def check_quiz(cls, v, info: ValidationInfo):
-        additional_info = info.data.get("additional_info")
-        if additional_info == "false" and v is None:
-            raise ValueError("Quiz should be None when additional_info is not 'false'")
-        return v
+    # runs once after pydantic-core validated all fields; a field validator on quiz
+    # would not see additional_info because it is declared after it
+    @model_validator(mode="after")
+    def check_quiz(self) -> "QuizOrInsufficientInfo":
+        if self.additional_info == "false" and self.quiz is None:
+            raise ValueError("Quiz should not be None when additional_info is 'false'")
+        return self
 
-output_parser = PydanticOutputParser(pydantic_object=QuizOrInsufficientInfo)
+# Anthropic tool use returns the response already parsed and validated against the schema
+structured_llm = llm.with_structured_output(QuizOrInsufficientInfo)
 
 system_message ="""You are a quiz generator. Try to generate a quiz about {quiz_topic} with multiple questions ONLY based on the following documents. Do not use any extra information from your knowledgebase.
-If the documents do not provide enough info, respond with as little words as possible in the format 'additional_info=Need data about ...'. The additional_info should be around 10-15 words.
+If the documents do not provide enough info, set additional_info with as little words as possible in the format 'Need data about ...'. The additional_info should be around 10-15 words.
 If they provide enough info, create the quiz and set additional_info='false'
 
-This is the context data: {context}
+This is the context data: {context}"""
 
-{format_instructions}
+uipath = UiPath()
 
-Respond with the classification in the requested JSON format."""
+# quizzes are cached by topic embedding so paraphrased topics skip retrieval and the LLM call
+SEMANTIC_CACHE_SIMILARITY_THRESHOLD = 0.95
+SEMANTIC_CACHE_MAX_SIZE = 256
+quiz_cache = InMemoryVectorStore(embedding=UiPathAzureOpenAIEmbeddings())
+quiz_cache_ids: OrderedDict[str, None] = OrderedDict()
 
-uipath = UiPath()
+# retrieved chunks are reused per (index, topic) within a 5 minutes window so newly ingested docs eventually surface
+RETRIEVAL_CACHE_MAX_SIZE = 256
+RETRIEVAL_CACHE_TTL_SECONDS = 300
+retrieval_cache: OrderedDict[tuple[str, Optional[str], str, int], list[Document]] = OrderedDict()
+
+# ingestion polling uses exponential backoff with jitter: 0.5, 1, 2, 4, 8, 8 seconds
+INGESTION_MAX_RETRIES = 7
+INGESTION_RETRY_INITIAL_DELAY = 0.5
+INGESTION_RETRY_MAX_DELAY = 8.0
+INGESTION_RETRY_JITTER = 0.2
+
+# only the most relevant chunks are sent to the LLM, capped at roughly 4k tokens
+CONTEXT_TOP_K = 3
+CONTEXT_MAX_CHARS = 16_000
+
+retrievers: dict[tuple[str, str], ContextGroundingRetriever] = {}
 
 
 class GraphOutput(BaseModel):
@@ -80,6 +135,7 @@ class GraphState(MessagesState):
     index_folder_path: str
     additional_info: Optional[str]
     quiz: Optional[Quiz]
+    new_data_uploaded: bool
 
 def prepare_input(state: GraphInput) -> GraphState:
     return GraphState(
@@ -89,6 +145,7 @@ def prepare_input(state: GraphInput) -> GraphState:
         messages=([f"create a quiz about {state.quiz_topic}"]),
         quiz=None,
         index_folder_path=state.index_folder_path,
+        new_data_uploaded=True,
     )
 
 async def invoke_researcher(state: GraphState) -> Command:
@@ -104,68 +161,197 @@ async def invoke_researcher(state: GraphState) -> Command:
         # folder_path="<the path of the folder that the researcher agent resides in>"
     ))
 
+    new_data_uploaded = agent_response.get("new_data_uploaded", True)
+    if new_data_uploaded:
+        # the researcher added new documents to the index, previously retrieved chunks are stale
+        invalidate_retrieval_cache(state["index_name"], state["index_folder_path"])
+
     return Command(
         update={
             "messages": [agent_response["messages"][-1]],
+            "new_data_uploaded": new_data_uploaded,
         })
 
+def get_retriever(index_name: str, index_folder_path: str) -> ContextGroundingRetriever:
+    key = (index_name, index_folder_path)
+    if key not in retrievers:
+        retrievers[key] = ContextGroundingRetriever(
+            index_name=index_name,
+            uipath_sdk=uipath,
+            number_of_results=10,
+            folder_path=index_folder_path,
+        )
+    return retrievers[key]
+
+def invalidate_retrieval_cache(index_name: str, index_folder_path: Optional[str]) -> None:
+    for key in [key for key in retrieval_cache if key[:2] == (index_name, index_folder_path)]:
+        del retrieval_cache[key]
+
+async def search_index(retriever: ContextGroundingRetriever, quiz_topic: str) -> list[Document]:
+    try:
+        return await retriever.ainvoke(quiz_topic)
+    except httpx.HTTPStatusError as err:
+        if err.response.status_code == 404:
+            raise IndexNotFound
+        raise
+
+def ingestion_retry_delays() -> Iterator[float]:
+    delay = INGESTION_RETRY_INITIAL_DELAY
+    for _ in range(INGESTION_MAX_RETRIES - 1):
+        yield delay + random.uniform(0, INGESTION_RETRY_JITTER)
+        delay = min(delay * 2, INGESTION_RETRY_MAX_DELAY)
+
+async def wait_for_ingestion(index_name: str, index_folder_path: Optional[str], retry_delays: Iterator[float]) -> None:
+    # poll the lightweight index status instead of re-running the search until ingestion completes;
+    # every call consumes at least one delay so the shared retry budget always runs out
+    while True:
+        delay = next(retry_delays, None)
+        if delay is None:
+            raise Exception("Ingestion is taking too long.")
+        logger.info("Ingestion in progress for index %s, checking again in %.1f seconds", index_name, delay)
+        await asyncio.sleep(delay)
+        index = await uipath.context_grounding.retrieve_async(index_name, folder_path=index_folder_path)
+        if not index.in_progress_ingestion():
+            return
+
 async def get_context_data_async(retriever: ContextGroundingRetriever, quiz_topic: str) -> list[Document]:
-    no_of_retries = 5
-    context_data = None
-    data_queried = False
-    while no_of_retries != 0:
+    cache_key = (
+        retriever.index_name,
+        retriever.folder_path,
+        quiz_topic,
+        int(time.time() // RETRIEVAL_CACHE_TTL_SECONDS),
+    )
+    if cache_key in retrieval_cache:
+        retrieval_cache.move_to_end(cache_key)
+        return retrieval_cache[cache_key]
+
+    # a new ingestion can start between the status poll and the search, so retry both within one budget
+    retry_delays = ingestion_retry_delays()
+    while True:
         try:
-            context_data = await retriever.ainvoke(quiz_topic)
-            data_queried = True
+            context_data = await search_index(retriever, quiz_topic)
             break
         except IngestionInProgressException as ex:
             logger.info(ex.message)
-            no_of_retries -= 1
-            logger.info(f"{no_of_retries} retries left")
-            time.sleep(5)
-        except httpx.HTTPStatusError as err:
-            if err.response.status_code == 404:
-                raise IndexNotFound
-            raise
-    if not data_queried:
-        raise Exception("Ingestion is taking too long.")
+            await wait_for_ingestion(retriever.index_name, retriever.folder_path, retry_delays)
+
+    retrieval_cache[cache_key] = context_data
+    if len(retrieval_cache) > RETRIEVAL_CACHE_MAX_SIZE:
+        retrieval_cache.popitem(last=False)
     return  context_data
 
+async def get_cached_quiz(index_name: str, index_folder_path: str, quiz_topic: str) -> Optional[Quiz]:
+    # the cache is best effort: skip the embeddings call while it is empty and never fail the node on it
+    if not quiz_cache_ids:
+        return None
+    try:
+        hits = await quiz_cache.asimilarity_search_with_score(
+            quiz_topic,
+            k=1,
+            filter=lambda doc: doc.metadata["index"] == (index_name, index_folder_path),
+        )
+        if hits and hits[0][1] >= SEMANTIC_CACHE_SIMILARITY_THRESHOLD:
+            document = hits[0][0]
+            quiz_cache_ids.move_to_end(document.id)
+            return Quiz.model_validate(document.metadata["quiz"])
+    except Exception:
+        logger.debug("Semantic quiz cache lookup failed", exc_info=True)
+    return None
+
+async def cache_quiz(index_name: str, index_folder_path: str, quiz_topic: str, quiz: Quiz) -> None:
+    try:
+        ids = await quiz_cache.aadd_documents(
+            [Document(
+                page_content=quiz_topic,
+                metadata={"index": (index_name, index_folder_path), "quiz": quiz.model_dump()},
+            )]
+        )
+        quiz_cache_ids.update(dict.fromkeys(ids))
+        # evict the least recently used quizzes, every lookup is a linear scan over the store
+        while len(quiz_cache_ids) > SEMANTIC_CACHE_MAX_SIZE:
+            evicted_id, _ = quiz_cache_ids.popitem(last=False)
+            await quiz_cache.adelete([evicted_id])
+    except Exception:
+        # a cache failure must not discard the quiz that was just generated
+        logger.debug("Could not add quiz to the semantic cache", exc_info=True)
+
+def bm25_scores(documents: list[Document], query: str, k1: float = 1.5, b: float = 0.75) -> list[float]:
+    corpus = [doc.page_content.lower().split() for doc in documents]
+    avg_length = sum(len(tokens) for tokens in corpus) / len(corpus) or 1.0
+    query_terms = set(query.lower().split())
+    document_frequency = {term: sum(term in tokens for tokens in corpus) for term in query_terms}
+    scores = []
+    for tokens in corpus:
+        score = 0.0
+        for term in query_terms:
+            frequency = tokens.count(term)
+            if not frequency:
+                continue
+            idf = math.log(1 + (len(corpus) - document_frequency[term] + 0.5) / (document_frequency[term] + 0.5))
+            score += idf * frequency * (k1 + 1) / (frequency + k1 * (1 - b + b * len(tokens) / avg_length))
+        scores.append(score)
+    return scores
+
+def build_context(documents: list[Document], quiz_topic: str) -> str:
+    # rerank the retrieved chunks with BM25 (ties keep the retriever order) and serialize only their content
+    scores = bm25_scores(documents, quiz_topic)
+    ranking = sorted(range(len(documents)), key=lambda i: -scores[i])
+    context = "\n\n".join(documents[i].page_content for i in ranking[:CONTEXT_TOP_K])
+    return context[:CONTEXT_MAX_CHARS]
+
 async def create_quiz(state: GraphState) -> Command:
-    retriever = ContextGroundingRetriever(
-                index_name=state["index_name"],
-                uipath_sdk=uipath,
-                number_of_results=10,
-                folder_path=state["index_folder_path"],
+    # a complete quiz ends the graph, so the cache can only hit before the first researcher reply
+    if len(state["messages"]) == 1:
+        cached_quiz = await get_cached_quiz(state["index_name"], state["index_folder_path"], state["quiz_topic"])
+        if cached_quiz is not None:
+            return Command(
+                update={
+                    "quiz": cached_quiz,
+                    "additional_info": "false",
+                }
             )
+
+    retriever = get_retriever(state["index_name"], state["index_folder_path"])
     try:
         context_data = await get_context_data_async(retriever, state["quiz_topic"])
     except IndexNotFound:
         context_data = ""
 
-    message = system_message.format(format_instructions=output_parser.get_format_instructions(),
-        context = context_data if context_data else "No context grounding data available yet",
+    message = system_message.format(
+        context = build_context(context_data, state["quiz_topic"]) if context_data else "No context grounding data available yet",
         quiz_topic=state["quiz_topic"])
 
-    result = await llm.ainvoke(message)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("create_quiz prompt: %s", message)
     try:
-        llm_response = output_parser.parse(result.content)
-        return Command(
-            update={
-                "quiz": llm_response.quiz if llm_response.additional_info == "false" else None,
-                "additional_info": llm_response.additional_info,
-            }
-        )
-    except Exception as e:
+        llm_response = await structured_llm.ainvoke(message)
+    except (OutputParserException, ValidationError):
+        logger.debug("Could not parse LLM response", exc_info=True)
+        return Command(goto=END)
+    if llm_response is None:
         return Command(goto=END)
 
-def check_quiz_creation(state: GraphState) -> Literal["invoke_researcher", "return_quiz"]:
+    # only grounded, complete quizzes are admitted to the cache
+    if llm_response.additional_info == "false" and llm_response.quiz is not None:
+        await cache_quiz(state["index_name"], state["index_folder_path"], state["quiz_topic"], llm_response.quiz)
+    return Command(
+        update={
+            "quiz": llm_response.quiz if llm_response.additional_info == "false" else None,
+            "additional_info": llm_response.additional_info,
+        }
+    )
+
+def check_quiz_creation(state: GraphState) -> Literal["invoke_researcher", "return_quiz", "__end__"]:
     if state["additional_info"] != "false":
+        # stop when the last researcher run found nothing new, another run would repeat the same search
+        if not state["new_data_uploaded"]:
+            return END
         return "invoke_researcher"
     return "return_quiz"
 
 def return_quiz(state: GraphState) -> GraphOutput:
-    return GraphOutput(quiz=state["quiz"])
+    # model_construct skips validation, the quiz was already validated when the LLM response was parsed
+    return GraphOutput.model_construct(quiz=state["quiz"])
 
 # Build the state graph
 builder = StateGraph(GraphState, input=GraphInput, output=GraphOutput)
@@ -182,3 +368,26 @@ builder.add_edge("return_quiz", END)
 
 # Compile the graph
 graph = builder.compile()
+
+class BatchResult(BaseModel):
+    thread_id: str
+    quiz: Optional[Quiz] = None
+    # the run suspended on the researcher invocation; it can only be resumed on thread_id with a checkpointer
+    interrupted: bool = False
+
+async def generate_many(
+    inputs: list[GraphInput],
+    checkpointer: Optional[BaseCheckpointSaver] = None,
+    max_concurrency: int = 8,
+) -> list[BatchResult]:
+    # run the graph for several topics concurrently, the async nodes overlap their retrieval and LLM calls
+    batch_graph = builder.compile(checkpointer=checkpointer) if checkpointer is not None else graph
+    thread_ids = [uuid.uuid4().hex for _ in inputs]
+    outputs = await batch_graph.abatch(
+        inputs,
+        config=[{"configurable": {"thread_id": thread_id}, "max_concurrency": max_concurrency} for thread_id in thread_ids],
+    )
+    return [
+        BatchResult(thread_id=thread_id, quiz=output.get("quiz"), interrupted="__interrupt__" in output)
+        for thread_id, output in zip(thread_ids, outputs)
+    ]
@@ -1,18 +1,30 @@
-from typing import Optional
+from typing import List, Optional
+import asyncio
+import hashlib
+import os
+import sqlite3
 import time
+import uuid
 from langchain_anthropic import ChatAnthropic
 from langchain_tavily import TavilySearch
 from langgraph.graph import END, START, MessagesState, StateGraph
-from langchain.agents import create_agent
 from langgraph.types import Command
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from uipath.platform import UiPath
-from langchain_core.messages import AIMessage, SystemMessage, HumanMessage
+from langchain_core.messages import AIMessage, SystemMessage
 from uipath.platform.context_grounding import ContextGroundingIndex
 
 uipath = UiPath()
 tavily_tool = TavilySearch(max_results=5)
 anthropic_model = "claude-3-7-sonnet-latest"
+MAX_SEARCH_QUERIES = 4
+# Context Grounding ingests plain text only, so uploads are capped instead of gzip compressed
+MAX_UPLOAD_CHARS = 200_000
+# near-duplicate chunks (SimHash within 3 of 64 bits) of previously uploaded data are dropped before upload;
+# hashes live in a local SQLite file, point UPLOAD_HASHES_DB_PATH to persistent storage to dedup across jobs
+UPLOAD_HASHES_DB_PATH = os.getenv("UPLOAD_HASHES_DB_PATH", ".upload_hashes.db")
+DEDUP_CHUNK_WORDS = 500
+DEDUP_MAX_HAMMING_DISTANCE = 3
 
 
 llm = ChatAnthropic(model=anthropic_model)
@@ -23,8 +35,20 @@ class GraphInput(BaseModel):
     index_name: str
     index_folder_path: str
 
+class GraphOutput(MessagesState):
+    new_data_uploaded: bool
+
+class SearchQueries(BaseModel):
+    queries: List[str] = Field(
+        description="Independent web search queries that together cover the search instructions"
+    )
+
+# the model answers with a tool call that is parsed into SearchQueries, or None when it makes no tool call
+planner = llm.with_structured_output(SearchQueries)
+
 class GraphState(BaseModel):
     search_instructions: str
+    search_queries: List[str]
     web_results: str
     index_name: str
     index_folder_path: str
@@ -32,8 +56,10 @@ class GraphState(BaseModel):
     index: Optional[ContextGroundingIndex]
 
 def prepare_input(state: GraphInput) -> GraphState:
-    return GraphState(
+    # model_construct skips validation, the fields come from the already validated GraphInput
+    return GraphState.model_construct(
         search_instructions=state.search_instructions,
+        search_queries=[],
         web_results="",
         file_name=None,
         index=None,
@@ -41,20 +67,39 @@ def prepare_input(state: GraphInput) -> GraphState:
         index_folder_path=state.index_folder_path,
     )
 
+async def plan_research(state: GraphState) -> Command:
+    search_queries = await planner.ainvoke(
+        [SystemMessage(
+            "As an AI research specialist, your task is to break the user's specified search_instructions into "
+            f"at most {MAX_SEARCH_QUERIES} distinct web search queries that can be run independently of each other."
+        ),
+        state.search_instructions])
+
+    return Command(
+        update={
+            "search_queries": (search_queries and search_queries.queries[:MAX_SEARCH_QUERIES]) or [state.search_instructions],
+        })
+
 async def research_node(state: GraphState) -> Command:
-    research_agent = create_agent(
-        llm, tools=[tavily_tool],
-        system_prompt=("As an AI research specialist, your task is to scour the internet for pertinent information based on the user's specified search_instructions."
-                " Avoid summarizing or organizing the content; simply gather raw, unprocessed information. Do not engage in follow-up questions or discussions, "
-                "focus solely on compiling data as you find it online.")
+    # run all search queries concurrently and compile the raw, unprocessed results
+    responses = await asyncio.gather(
+        *[tavily_tool.ainvoke({"query": query}) for query in state.search_queries]
     )
-    result = await research_agent.ainvoke(
-        {"messages": [HumanMessage(content=state.search_instructions)]}
-    )
-    web_results = result["messages"][-1].content
+    seen_urls = set()
+    web_results = []
+    for response in responses:
+        # TavilySearch handles tool errors (e.g. a query without results) by returning the error message as a string
+        if not isinstance(response, dict) or "error" in response:
+            continue
+        for result in response.get("results", []):
+            if result["url"] in seen_urls:
+                continue
+            seen_urls.add(result["url"])
+            web_results.append(f"{result['title']}\n{result['url']}\n{result['content']}")
+
     return Command(
         update={
-            "web_results": web_results,
+            "web_results": "\n\n".join(web_results),
         })
 
 async def create_file_name(state: GraphState) -> Command:
@@ -75,22 +120,104 @@ async def create_file_name(state: GraphState) -> Command:
         })
 
 
-async def add_data_to_context_grounding_index(state: GraphState) -> MessagesState:
-    current_timestamp = int(time.time())
-    file_name = state.file_name
+def split_into_chunks(text: str) -> List[str]:
+    chunks, current, current_words = [], [], 0
+    for paragraph in text.split("\n\n"):
+        words = paragraph.split()
+        # a single long page is cut into windows of DEDUP_CHUNK_WORDS words
+        pieces = [paragraph] if len(words) <= DEDUP_CHUNK_WORDS else [
+            " ".join(words[i:i + DEDUP_CHUNK_WORDS]) for i in range(0, len(words), DEDUP_CHUNK_WORDS)
+        ]
+        for piece in pieces:
+            piece_words = len(piece.split())
+            if current and current_words + piece_words > DEDUP_CHUNK_WORDS:
+                chunks.append("\n\n".join(current))
+                current, current_words = [], 0
+            current.append(piece)
+            current_words += piece_words
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+def simhash(text: str) -> int:
+    words = text.lower().split()
+    shingles = [" ".join(words[i:i + 3]) for i in range(max(len(words) - 2, 1))]
+    weights = [0] * 64
+    for shingle in shingles:
+        value = int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(64):
+            weights[bit] += 1 if value >> bit & 1 else -1
+    return sum(1 << bit for bit, weight in enumerate(weights) if weight > 0)
+
+def open_upload_hashes_db() -> sqlite3.Connection:
+    connection = sqlite3.connect(UPLOAD_HASHES_DB_PATH)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS upload_hashes (index_name TEXT, folder_path TEXT, simhash TEXT)"
+    )
+    return connection
+
+def load_upload_hashes(index_name: str, folder_path: str) -> List[int]:
+    connection = open_upload_hashes_db()
+    try:
+        return [
+            int(row[0], 16) for row in connection.execute(
+                "SELECT simhash FROM upload_hashes WHERE index_name = ? AND folder_path = ?",
+                (index_name, folder_path),
+            )
+        ]
+    finally:
+        connection.close()
+
+def store_upload_hashes(index_name: str, folder_path: str, hashes: List[int]) -> None:
+    connection = open_upload_hashes_db()
+    try:
+        with connection:
+            connection.executemany(
+                "INSERT INTO upload_hashes (index_name, folder_path, simhash) VALUES (?, ?, ?)",
+                [(index_name, folder_path, f"{h:016x}") for h in hashes],
+            )
+    finally:
+        connection.close()
+
+def deduplicate_web_results(web_results: str, known_hashes: List[int]) -> tuple[str, List[int]]:
+    known_hashes = list(known_hashes)
+    new_chunks, new_hashes = [], []
+    for chunk in split_into_chunks(web_results[:MAX_UPLOAD_CHARS]):
+        if not chunk.strip():
+            continue
+        chunk_hash = simhash(chunk)
+        if any((chunk_hash ^ known).bit_count() <= DEDUP_MAX_HAMMING_DISTANCE for known in known_hashes):
+            continue
+        known_hashes.append(chunk_hash)
+        new_chunks.append(chunk)
+        new_hashes.append(chunk_hash)
+    return "\n\n".join(new_chunks), new_hashes
+
+async def add_data_to_context_grounding_index(state: GraphState) -> GraphOutput:
+    # SQLite access and hashing are blocking, keep them off the event loop
+    known_hashes = await asyncio.to_thread(load_upload_hashes, state.index_name, state.index_folder_path)
+    web_results, new_hashes = await asyncio.to_thread(deduplicate_web_results, state.web_results, known_hashes)
+    # nothing to upload when every search failed or all chunks were already uploaded
+    if not new_hashes or not web_results.strip():
+        return GraphOutput(messages=[AIMessage("No new relevant information found.")], new_data_uploaded=False)
+
+    # nanosecond timestamp plus a random suffix keeps concurrent researcher runs from overwriting each other
+    blob_file_path = f"{state.file_name}-{time.time_ns()}-{uuid.uuid4().hex[:8]}.txt"
     await uipath.context_grounding.add_to_index_async(
         name=state.index_name,
-        blob_file_path=f"{file_name}-{current_timestamp}.txt",
-        content_type="application/txt",
-        content=state.web_results,
+        blob_file_path=blob_file_path,
+        content_type="text/plain; charset=utf-8",
+        content=web_results.encode("utf-8"),
         folder_path=state.index_folder_path,
     )
-    return MessagesState(messages=[AIMessage("Relevant information uploaded to bucket.")])
+    await asyncio.to_thread(store_upload_hashes, state.index_name, state.index_folder_path, new_hashes)
+    return GraphOutput(messages=[AIMessage("Relevant information uploaded to bucket.")], new_data_uploaded=True)
 
 
 
 # Build the state graph
-builder = StateGraph(GraphState ,input=GraphInput, output=MessagesState)
+builder = StateGraph(GraphState ,input=GraphInput, output=GraphOutput)
+builder.add_node("plan_research", plan_research)
 builder.add_node("research", research_node)
 builder.add_node("add_data_to_context_grounding_index", add_data_to_context_grounding_index)
 builder.add_node("prepare_input", prepare_input)
@@ -98,7 +225,8 @@ builder.add_node("create_file_name", create_file_name)
 
 builder.add_edge(START, "prepare_input")
 builder.add_edge("prepare_input", "create_file_name")
-builder.add_edge("create_file_name", "research")
+builder.add_edge("create_file_name", "plan_research")
+builder.add_edge("plan_research", "research")
 builder.add_edge("research", "add_data_to_context_grounding_index")
 builder.add_edge("add_data_to_context_grounding_index", END)
 
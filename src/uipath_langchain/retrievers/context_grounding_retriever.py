@@ -4,6 +4,7 @@ from langchain_core.callbacks import (
 )
 from langchain_core.documents import Document
 from langchain_core.retrievers import BaseRetriever
+from pydantic import PrivateAttr
 from uipath.platform import UiPath
 
 
@@ -14,12 +15,22 @@ class ContextGroundingRetriever(BaseRetriever):
     uipath_sdk: UiPath | None = None
     number_of_results: int | None = 10
 
+    _default_sdk: UiPath | None = PrivateAttr(default=None)
+
+    def _get_sdk(self) -> UiPath:
+        """Return the configured SDK, creating and reusing a default one so its HTTP clients keep their connection pools."""
+        if self.uipath_sdk is not None:
+            return self.uipath_sdk
+        if self._default_sdk is None:
+            self._default_sdk = UiPath()
+        return self._default_sdk
+
     def _get_relevant_documents(
         self, query: str, *, run_manager: CallbackManagerForRetrieverRun
     ) -> list[Document]:
         """Sync implementations for retriever calls context_grounding API to search the requested index."""
 
-        sdk = self.uipath_sdk if self.uipath_sdk is not None else UiPath()
+        sdk = self._get_sdk()
         results = sdk.context_grounding.search(
             self.index_name,
             query,
@@ -44,7 +55,7 @@ class ContextGroundingRetriever(BaseRetriever):
     ) -> list[Document]:
         """Async implementations for retriever calls context_grounding API to search the requested index."""
 
-        sdk = self.uipath_sdk if self.uipath_sdk is not None else UiPath()
+        sdk = self._get_sdk()
         results = await sdk.context_grounding.search_async(
             self.index_name,
             query,
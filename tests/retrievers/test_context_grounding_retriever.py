@@ -0,0 +1,36 @@
+from unittest.mock import MagicMock, patch
+
+from uipath.platform import UiPath
+
+from uipath_langchain.retrievers import ContextGroundingRetriever
+
+
+class TestContextGroundingRetrieverSdk:
+    """Tests for the SDK instance used by ContextGroundingRetriever."""
+
+    def test_uses_provided_sdk(self):
+        """Test that an explicitly passed SDK is used as-is."""
+        sdk = MagicMock(spec=UiPath)
+        sdk.context_grounding.search.return_value = []
+
+        with patch(
+            "uipath_langchain.retrievers.context_grounding_retriever.UiPath"
+        ) as uipath_cls:
+            retriever = ContextGroundingRetriever(index_name="index", uipath_sdk=sdk)
+            retriever.invoke("query")
+
+        uipath_cls.assert_not_called()
+        sdk.context_grounding.search.assert_called_once()
+
+    def test_default_sdk_is_reused_across_calls(self):
+        """Test that the default SDK is created once and reused for later queries."""
+        with patch(
+            "uipath_langchain.retrievers.context_grounding_retriever.UiPath"
+        ) as uipath_cls:
+            uipath_cls.return_value.context_grounding.search.return_value = []
+            retriever = ContextGroundingRetriever(index_name="index")
+            retriever.invoke("first query")
+            retriever.invoke("second query")
+
+        uipath_cls.assert_called_once_with()
+        assert uipath_cls.return_value.context_grounding.search.call_count == 2